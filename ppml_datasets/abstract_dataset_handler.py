@@ -1,13 +1,11 @@
 import tensorflow as tf
 import tensorflow_datasets as tfds
 import numpy as np
-from sklearn.utils import class_weight
 
-from tensorflow.keras.layers import Layer, Resizing, Rescaling, RandomFlip, RandomRotation, RandomTranslation, RandomZoom
+from tensorflow.keras.layers import Layer, RandomFlip, RandomRotation, RandomTranslation, RandomZoom
 from dataclasses import dataclass, field
 from collections import defaultdict
 from typing import Tuple, Dict, Any, Optional, List, Union, Callable
-import scipy.stats
 import os
 import math
 
@@ -29,6 +27,11 @@ class AbstractDataset():
     is_tfds_ds: bool
     # if True, automatically builds ds_info after loading dataset data
     builds_ds_info: bool = field(default=False, repr=False)
+    # if True, build_ds_info also calculates the data entropy, which needs a full pass over the image data of the train dataset
+    compute_entropy: bool = field(default=False, repr=False)
+    # if True and a GPU is available, the prepared train dataset is prefetched to the GPU memory
+    # NOTE: the cardinality of the train dataset is unknown afterwards, so len(ds_train) and get_dataset_count() do not work anymore
+    prefetch_train_to_device: bool = field(default=False, repr=False)
 
     # model specific preprocessing for the dataset like: tf.keras.applications.resnet50.preprocess_input
     preprocessing_function: Optional[Callable[[float], tf.Tensor]] = None
@@ -39,6 +42,8 @@ class AbstractDataset():
     dataset_img_shape: Optional[Tuple[int, int, int]] = None
     # optionally providable class_names, only for cosmetic purposes when printing out ds_info
     class_names: Optional[List[str]] = None
+    # number of classes in the dataset, if set the class distribution is counted without collecting all labels
+    num_classes: Optional[int] = None
 
     random_rotation: Optional[float] = 0.1
     random_zoom: Optional[float] = 0.15
@@ -47,7 +52,12 @@ class AbstractDataset():
     random_translation_width: Optional[float] = 0.1
     random_translation_height: Optional[float] = 0.1
 
+    # if set, prepared datasets are stored as snapshots in this directory and reused across runs instead of being cached in memory
+    cache_dir: Optional[str] = None
+
     random_seed: int = 42
+    # upper bound for the shuffle buffer size, so that large datasets don't have to be held completely in the buffer
+    shuffle_buffer_cap: int = 10000
     repeat: bool = False
 
     class_labels: Optional[Tuple[Any]] = None
@@ -83,25 +93,28 @@ class AbstractDataset():
 
         if fn_filter is not None:
             if self.ds_train is not None:
-                self.ds_train = self.ds_train.filter(fn_filter)
-
-                # we need to reset cardinality since is likely that the info is lost after filtering
-                ds_len = sum(1 for _ in self.ds_train)
-                self.ds_train = self.ds_train.apply(tf.data.experimental.assert_cardinality(ds_len))
+                self.ds_train = self._filter_ds(self.ds_train, fn_filter)
 
             if self.ds_test is not None:
-                self.ds_test = self.ds_test.filter(fn_filter)
-
-                # we need to reset cardinality since is likely that the info is lost after filtering
-                ds_len = sum(1 for _ in self.ds_test)
-                self.ds_test = self.ds_test.apply(tf.data.experimental.assert_cardinality(ds_len))
+                self.ds_test = self._filter_ds(self.ds_test, fn_filter)
 
             if self.ds_val is not None:
-                self.ds_val = self.ds_val.filter(fn_filter)
+                self.ds_val = self._filter_ds(self.ds_val, fn_filter)
+
+    def _filter_ds(self, ds: tf.data.Dataset, fn_filter) -> tf.data.Dataset:
+        """Filter dataset and reset its cardinality."""
+        ds = ds.filter(fn_filter)
+
+        # we need to reset cardinality since is likely that the info is lost after filtering
+        ds_len = self._count_ds(ds)
+        return ds.apply(tf.data.experimental.assert_cardinality(ds_len))
 
-                # we need to reset cardinality since is likely that the info is lost after filtering
-                ds_len = sum(1 for _ in self.ds_val)
-                self.ds_val = self.ds_val.apply(tf.data.experimental.assert_cardinality(ds_len))
+    def _count_ds(self, ds: tf.data.Dataset) -> int:
+        """Count the datapoints of a dataset with unknown cardinality.
+
+        Counting is done as a graph reduce, the images are still decoded (and filtered) upstream but not carried into the reduce.
+        """
+        return int(ds.map(lambda _, y: 1).reduce(np.int64(0), lambda a, _: a + 1).numpy())
 
     def __load_from_tfds(self):
         """Load dataset from tensorflow_datasets via 'dataset_name'."""
@@ -114,11 +127,19 @@ class AbstractDataset():
         else:
             data_dir = None
 
+        # read and decode multiple tfrecord shards in parallel
+        read_config = tfds.ReadConfig(
+            interleave_cycle_length=tf.data.AUTOTUNE,
+            num_parallel_calls_for_interleave_files=tf.data.AUTOTUNE,
+            num_parallel_calls_for_decode=tf.data.AUTOTUNE
+        )
+
         ds_dict: dict = tfds.load(
             name=self.dataset_name,
             data_dir=data_dir,
             as_supervised=True,
-            with_info=False
+            with_info=False,
+            read_config=read_config
         )
 
         if "val" in ds_dict.keys():
@@ -149,17 +170,9 @@ class AbstractDataset():
         If percentage_loaded_data is specified, than only this fraction of the merged dataset is used for splitting,
         effectively reducing the number of samples in each dataset.
         """
-        ds = self.ds_train
-        if self.ds_test is not None:
-            ds = ds.concatenate(self.ds_test)
-
-        if self.ds_val is not None:
-            ds = ds.concatenate(self.ds_val)
-
-        if percentage_loaded_data != 100:
-            new_ds_size = math.ceil(len(ds) * (self.percentage_loaded_data / 100.0))
-            ds = ds.take(new_ds_size)
+        ds = self._merge_datasets(percentage_loaded_data)
 
+        self.train_val_test_split = train_val_test_split
         train_split = self.train_val_test_split[0]
         val_split = self.train_val_test_split[1]
         test_split = self.train_val_test_split[2]
@@ -195,18 +208,39 @@ class AbstractDataset():
 
         A percentage can be specified, than only this percentage of the old data is used for the new train_ds after merging.
         """
-        ds = self.ds_train
-        if self.ds_test is not None:
-            ds = ds.concatenate(self.ds_test)
+        ds = self._merge_datasets(percentage_loaded_data)
 
-        if self.ds_val is not None:
-            ds = ds.concatenate(self.ds_val)
+        self.ds_train = ds
+
+    def _merge_datasets(self, percentage_loaded_data: int = 100) -> tf.data.Dataset:
+        """Merge all datasets (train, val, test) into one dataset.
+
+        The datasets are sampled randomly, weighted by their size, instead of being concatenated, so that the samples of all datasets are interleaved.
+        If the size of a dataset is unknown (f.e. after filtering), the datasets are concatenated instead.
+        """
+        splits = [ds for ds in (self.ds_train, self.ds_test, self.ds_val) if ds is not None]
+        split_lens = [int(ds.cardinality()) for ds in splits]
+
+        # sampling needs the size of every dataset as weight (and at least one non-empty dataset)
+        if all(split_len >= 0 for split_len in split_lens) and sum(split_lens) > 0:
+            ds_len = sum(split_lens)
+            ds = tf.data.Dataset.sample_from_datasets(splits, weights=split_lens,
+                                                      seed=self.random_seed, stop_on_empty_dataset=False)
+            # cardinality is unknown after sampling, but since all datasets are drained completely it is the sum of all datasets
+            ds = ds.apply(tf.data.experimental.assert_cardinality(ds_len))
+        else:
+            ds = splits[0]
+            for split in splits[1:]:
+                ds = ds.concatenate(split)
+
+            if percentage_loaded_data != 100:
+                ds_len = self._count_ds(ds)
 
         if percentage_loaded_data != 100:
-            new_ds_size = math.ceil(len(ds) * (self.percentage_loaded_data / 100.0))
+            new_ds_size = math.ceil(ds_len * (percentage_loaded_data / 100.0))
             ds = ds.take(new_ds_size)
 
-        self.ds_train = ds
+        return ds
 
     def set_class_names(self, class_names: List[str]):
         self.class_names = class_names
@@ -218,25 +252,29 @@ class AbstractDataset():
         Augmentation is applied to train dataset if specified, augmentation is never applied to validation or test dataset
 
         """
-        # prepare attack datasets
-        # we need to first prepare the attack DS since they depend on the unmodified original datasets
-        self.ds_attack_train = self.prepare_ds(self.ds_train, cache=True, resize_rescale=True,
+        # the attack datasets and the train/test datasets share the resized and cached data, they only differ in batching,
+        # shuffling and augmentation, so no cache is needed in the single pipelines
+        shared_train = self._resize_and_cache_ds(self.ds_train, self.model_img_shape, self.batch_size, cache=True)
+        self.ds_attack_train = self.prepare_ds(shared_train, cache=False, resize_rescale=True,
                                                img_shape=self.model_img_shape,
                                                batch_size=1, convert_to_rgb=self.convert_to_rgb,
                                                preprocessing_func=self.preprocessing_function,
                                                shuffle=False, augment=False)
+
         if self.ds_test is not None:
-            self.ds_attack_test = self.prepare_ds(self.ds_test, cache=True, resize_rescale=True,
+            shared_test = self._resize_and_cache_ds(self.ds_test, self.model_img_shape, self.batch_size, cache=True)
+            self.ds_attack_test = self.prepare_ds(shared_test, cache=False, resize_rescale=True,
                                                   img_shape=self.model_img_shape,
                                                   batch_size=1, convert_to_rgb=self.convert_to_rgb,
                                                   preprocessing_func=self.preprocessing_function,
                                                   shuffle=False, augment=False)
 
-        self.ds_train = self.prepare_ds(self.ds_train, cache=True, resize_rescale=True,
+        self.ds_train = self.prepare_ds(shared_train, cache=False, resize_rescale=True,
                                         img_shape=self.model_img_shape,
                                         batch_size=self.batch_size, convert_to_rgb=self.convert_to_rgb,
                                         preprocessing_func=self.preprocessing_function,
-                                        shuffle=self.shuffle, augment=self.augment_train)
+                                        shuffle=self.shuffle, augment=self.augment_train,
+                                        prefetch_to_device=self.prefetch_train_to_device)
 
         if self.ds_val is not None:
             self.ds_val = self.prepare_ds(self.ds_val, cache=True, resize_rescale=True,
@@ -247,7 +285,7 @@ class AbstractDataset():
                                           shuffle=False, augment=False)
 
         if self.ds_test is not None:
-            self.ds_test = self.prepare_ds(self.ds_test, cache=True, resize_rescale=True,
+            self.ds_test = self.prepare_ds(shared_test, cache=False, resize_rescale=True,
                                            img_shape=self.model_img_shape, batch_size=self.batch_size,
                                            convert_to_rgb=self.convert_to_rgb,
                                            preprocessing_func=self.preprocessing_function,
@@ -261,7 +299,8 @@ class AbstractDataset():
                    preprocessing_func: Optional[Callable[[float], tf.Tensor]],
                    shuffle: bool,
                    augment: bool,
-                   cache: Union[str, bool] = True) -> tf.data.Dataset:
+                   cache: Union[str, bool] = True,
+                   prefetch_to_device: bool = False) -> tf.data.Dataset:
         """Prepare datasets for training and validation for the ResNet50 model.
 
         This function applies image resizing, resnet50-preprocessing to the dataset. Optionally the data can be shuffled or further get augmented (random flipping, etc.)
@@ -274,66 +313,179 @@ class AbstractDataset():
         batch_size: int | None - batch size specified by integer value, if None is passed, no batching is applied to the data
         convert_to_rgb: bool - if True, the data is converted vom grayscale to rgb values
         preprocessing: bool - if True, model specific preprocessing is applied to the data (currently resnet50_preprocessing)
-        shuffle: bool - if True, the data is shuffled, the used shuffle buffer for this has the size of the data
+        shuffle: bool - if True, the data is shuffled, the used shuffle buffer for this has the size of the data but at most 'shuffle_buffer_cap'
         augment: bool - if True, data augmentation (random flip, random rotation, random translation, random zoom, random brightness) is applied to the data
+        cache: str | bool - if True, the dataset is cached in memory, if a string is passed it is used as cache file. If 'cache_dir' is set, a snapshot is stored in 'cache_dir' instead
+        prefetch_to_device: bool - if True and a GPU is available, the data is prefetched to the GPU memory instead of the host memory,
+                                   the cardinality of the returned dataset is unknown then
 
         """
         AUTOTUNE = tf.data.AUTOTUNE
 
-        preprocessing_layers = tf.keras.models.Sequential()
+        options = tf.data.Options()
+        options.experimental_optimization.apply_default_optimizations = True
+        options.experimental_optimization.map_and_batch_fusion = True
+        options.experimental_optimization.parallel_batch = True
+        options.threading.private_threadpool_size = os.cpu_count()
+        # the element order only needs to be deterministic if the dataset is not shuffled anyway (f.e. attack datasets)
+        options.deterministic = not shuffle
+        ds = ds.with_options(options)
+
+        # preprocessing is split in two stages: resizing keeps the dtype of the data (mostly uint8) so that the cache and shuffle buffer
+        # hold as few bytes as possible, rgb conversion, rescaling and model preprocessing are applied as late as possible
+        rescale_ops: List[Callable[[tf.Tensor], tf.Tensor]] = []
         if convert_to_rgb:
-            preprocessing_layers.add(GrayscaleToRgb())
+            rescale_ops.append(tf.image.grayscale_to_rgb)
 
         if resize_rescale:
-            preprocessing_layers.add(Resizing(img_shape[0], img_shape[1]))
-            preprocessing_layers.add(Rescaling(scale=1. / 255.))
+            rescale_ops.append(lambda x: tf.cast(x, tf.float32) * (1. / 255.))
 
         if preprocessing_func:
-            preprocessing_layers.add(ModelPreprocessing(preprocessing_func))
-
-        if convert_to_rgb or resize_rescale or preprocessing_func:
-            ds = ds.map(lambda x, y: (preprocessing_layers(x), y),
-                        num_parallel_calls=AUTOTUNE)
+            rescale_ops.append(preprocessing_func)
+
+        def resize_ds(ds: tf.data.Dataset, batched: bool) -> tf.data.Dataset:
+            if resize_rescale:
+                ds = self._resize_ds(ds, img_shape, batched=batched)
+            return ds
+
+        def rescale_ds(ds: tf.data.Dataset, batched: bool) -> tf.data.Dataset:
+            if convert_to_rgb or resize_rescale or preprocessing_func:
+                rescale_fn = _jit_compile(_compose(rescale_ops),
+                                          ds.element_spec[0], batched=batched)
+                ds = ds.map(lambda x, y: (rescale_fn(x), y),
+                            num_parallel_calls=AUTOTUNE)
+            return ds
+
+        def cache_ds(ds: tf.data.Dataset) -> tf.data.Dataset:
+            return self._cache_ds(ds, cache, img_shape)
+
+        def shuffle_ds(ds: tf.data.Dataset) -> tf.data.Dataset:
+            card = ds.cardinality()
+            cap = tf.constant(self.shuffle_buffer_cap, tf.int64)
+            # cardinality can be unknown or infinite (negative values), then only the cap is used
+            buffer_size = tf.where(card > 0, tf.minimum(card, cap), cap)
+            return ds.shuffle(buffer_size=buffer_size, seed=self.random_seed, reshuffle_each_iteration=True)
+
+        # batching before preprocessing lets the preprocessing run on whole batches, but this is only possible for equally shaped images
+        batch_first = batch_size is not None and batch_size > 1 and ds.element_spec[0].shape.is_fully_defined()
+
+        if batch_first and not shuffle:
+            ds = ds.batch(batch_size, num_parallel_calls=AUTOTUNE)
+            ds = resize_ds(ds, batched=True)
+            ds = cache_ds(ds)
+        else:
+            # shuffled data is cached unbatched, otherwise the shuffled batches of the first epoch would be replayed from the cache
+            ds = self._resize_and_cache_ds(ds, img_shape, batch_size, cache, resize=resize_rescale)
 
-        if cache:
-            if isinstance(cache, str):
-                ds = ds.cache(cache)
-            else:
-                ds = ds.cache()
+            if shuffle:
+                ds = shuffle_ds(ds)
 
-        if shuffle:
-            ds = ds.shuffle(buffer_size=ds.cardinality().numpy(), seed=self.random_seed)
+            if batch_size is not None:
+                ds = ds.batch(batch_size, num_parallel_calls=AUTOTUNE)
 
-        if batch_size is not None:
-            ds = ds.batch(batch_size, num_parallel_calls=AUTOTUNE)
+        ds = rescale_ds(ds, batched=batch_size is not None)
 
         if augment:
-            augmentation_layers = tf.keras.models.Sequential()
+            augmentation_layers: List[Layer] = []
 
             if self.random_flip:
-                augmentation_layers.add(RandomFlip(self.random_flip))
+                augmentation_layers.append(RandomFlip(self.random_flip))
 
             if self.random_rotation:
-                augmentation_layers.add(RandomRotation(self.random_rotation, fill_mode="constant"))
+                augmentation_layers.append(RandomRotation(self.random_rotation, fill_mode="constant"))
 
             if self.random_translation_width and self.random_translation_height:
-                augmentation_layers.add(RandomTranslation(self.random_translation_height,
-                                                          self.random_translation_width, fill_mode="constant"))
+                augmentation_layers.append(RandomTranslation(self.random_translation_height,
+                                                             self.random_translation_width, fill_mode="constant"))
             if self.random_zoom:
-                augmentation_layers.add(RandomZoom(self.random_zoom, fill_mode="constant"))
+                augmentation_layers.append(RandomZoom(self.random_zoom, fill_mode="constant"))
 
             if self.random_brightness:
-                augmentation_layers.add(RandomBrightness(self.random_brightness))
+                augmentation_layers.append(RandomBrightness(self.random_brightness))
 
-            ds = ds.map(lambda x, y: (augmentation_layers(x, training=True), y),
+            augmentation_ops = [lambda x, layer=layer: layer(x, training=True) for layer in augmentation_layers]
+            augment_fn = _jit_compile(_compose(augmentation_ops),
+                                      ds.element_spec[0], batched=batch_size is not None)
+            ds = ds.map(lambda x, y: (augment_fn(x), y),
                         num_parallel_calls=AUTOTUNE)
 
+        if prefetch_to_device:
+            gpus = tf.config.list_logical_devices('GPU')
+            if gpus:
+                # copy the next batches to the GPU while the current one is being processed
+                return ds.apply(tf.data.experimental.prefetch_to_device(gpus[0].name, buffer_size=2))
+
         # Use buffered prefetching on all datasets.
         return ds.prefetch(buffer_size=AUTOTUNE)
 
+    def _resize_ds(self, ds: tf.data.Dataset, img_shape: Tuple[int, int, int], batched: bool) -> tf.data.Dataset:
+        """Resize image data to 'img_shape', integer image data keeps its dtype.
+
+        Resizing is skipped if the image data already has the target size.
+        """
+        shape = ds.element_spec[0].shape
+        if shape.rank is not None and shape[-3:-1].as_list() == list(img_shape[:2]):
+            return ds
+
+        def resize(x: tf.Tensor) -> tf.Tensor:
+            # resizing always returns float values, integer image data is cast back to its original dtype
+            resized = tf.image.resize(x, (img_shape[0], img_shape[1]))
+            if x.dtype.is_integer:
+                return tf.saturate_cast(tf.round(resized), x.dtype)
+            return resized
+
+        resize_fn = _jit_compile(resize, ds.element_spec[0], batched=batched)
+        return ds.map(lambda x, y: (resize_fn(x), y),
+                      num_parallel_calls=tf.data.AUTOTUNE)
+
+    def _cache_ds(self, ds: tf.data.Dataset, cache: Union[str, bool], img_shape: Tuple[int, int, int]) -> tf.data.Dataset:
+        """Cache dataset in memory, in the file 'cache' or as snapshot in 'cache_dir' if it is set."""
+        if cache:
+            if self.cache_dir is not None:
+                # tf.data stores snapshots of different pipelines in separate subdirectories (by fingerprint)
+                ds = ds.snapshot(os.path.join(self.cache_dir, f"{self.dataset_name}_{img_shape[0]}x{img_shape[1]}"))
+            elif isinstance(cache, str):
+                ds = ds.cache(cache)
+            else:
+                ds = ds.cache()
+        return ds
+
+    def _resize_and_cache_ds(self, ds: tf.data.Dataset,
+                             img_shape: Tuple[int, int, int],
+                             batch_size: Optional[int],
+                             cache: Union[str, bool],
+                             resize: bool = True) -> tf.data.Dataset:
+        """Resize and cache an unbatched dataset, the returned dataset is unbatched as well.
+
+        Equally shaped data is resized batch-wise and unbatched again before caching.
+        This is used to share the resized data between the attack dataset and the train/test dataset,
+        and in front of the shuffle buffer, so that the resizing is not repeated every epoch.
+        """
+        AUTOTUNE = tf.data.AUTOTUNE
+
+        shape = ds.element_spec[0].shape
+        batch_resize = batch_size is not None and batch_size > 1 and shape.is_fully_defined() and shape[:2].as_list() != list(img_shape[:2])
+
+        if resize and batch_resize:
+            # resize whole batches and unbatch again afterwards
+            ds_len = int(ds.cardinality())
+            ds = ds.batch(batch_size, num_parallel_calls=AUTOTUNE)
+            ds = self._resize_ds(ds, img_shape, batched=True).unbatch()
+
+            if ds_len >= 0:
+                # cardinality is lost by unbatching
+                ds = ds.apply(tf.data.experimental.assert_cardinality(ds_len))
+        elif resize:
+            ds = self._resize_ds(ds, img_shape, batched=False)
+
+        return self._cache_ds(ds, cache, img_shape)
+
     def calculate_class_weights(self) -> Tuple[Optional[Dict[int, int]], Optional[Dict[int, float]]]:
-        """Calculate class weights and class counts for train dataset."""
-        class_labels, class_counts, class_distribution = self.get_class_distribution()
+        """Calculate class weights and class counts for train dataset.
+
+        The class weights are 'balanced' weights, calculated directly from the class counts: n_samples / (n_classes * class_count)
+        """
+        class_labels, class_counts, _ = self.get_class_distribution()
 
         class_counts_dict: Dict[str, int] = {}
         for y, count in zip(class_labels, class_counts):
@@ -342,16 +494,17 @@ class AbstractDataset():
             else:
                 class_counts_dict[y] = count
 
-        weights = class_weight.compute_class_weight(class_weight='balanced',
-                                                    classes=np.unique(class_distribution),
-                                                    y=class_distribution)
+        counts = np.asarray(class_counts)
+        n: int = counts.sum()
+        k: int = len(counts)
+        weights = n / (k * counts.astype(np.float64))
 
         class_weights: Dict[str, float] = {}
         if self.class_names is not None and len(self.class_names) == len(class_labels):
-            for i, weight in enumerate(weights):
+            for y, weight in zip(class_labels, weights):
                 class_weights[f"{self.class_names[y]}({y})"] = weight
         else:
-            class_weights = dict(enumerate(weights))
+            class_weights = dict(zip(class_labels, weights))
         return (class_counts_dict, class_weights)
 
     def get_dataset_count(self) -> Dict[str, int]:
@@ -368,7 +521,7 @@ class AbstractDataset():
 
         return ds_count
 
-    def get_class_distribution(self, ds: Optional[tf.data.Dataset] = None, force_recalcuation: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    def get_class_distribution(self, ds: Optional[tf.data.Dataset] = None, force_recalcuation: bool = False) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
         """Calculate and return absolute class distribution from train dataset.
 
         This function returns the desired class_labels, class_counts and class_distribution values but also sets these variables as class variables.
@@ -382,20 +535,29 @@ class AbstractDataset():
 
         Return:
         ------
-        (np.ndarray, np.ndarray, np.ndarray): three numpy arrays
+        (np.ndarray, np.ndarray, np.ndarray | None): three numpy arrays
             -> first one containing the class number
             -> second one containing the number of datapoints in the class (ordered)
-            -> third one as a class representation for all datapoints
+            -> third one as a class representation for all datapoints, this is None if 'num_classes' is set
         f.e.: ([1,2,3,4,5],[404,133,313,122,10], [4,1,0,2,5,4,1,4,3,2,4,3,3,1,...])
 
         """
-        if self.class_counts is not None and self.class_labels is not None and self.class_distribution is not None and force_recalcuation is not True:
+        if self.class_counts is not None and self.class_labels is not None and force_recalcuation is not True:
             return (self.class_labels, self.class_counts, self.class_distribution)
 
-        if ds is not None:
-            y_train = np.fromiter(ds.map(lambda _, y: y), int)
-        else:
-            y_train = np.fromiter(self.ds_train.map(lambda _, y: y), int)
+        if ds is None:
+            ds = self.ds_train
+
+        if self.num_classes is not None:
+            class_labels, class_counts = self._count_labels(ds, self.num_classes)
+
+            self.class_labels = class_labels
+            self.class_counts = class_counts
+            self.class_distribution = None
+
+            return (class_labels, class_counts, None)
+
+        y_train = self._collect_labels(ds)
 
         distribution = np.unique(y_train, return_counts=True)
 
@@ -405,6 +567,44 @@ class AbstractDataset():
 
         return distribution + (y_train,)
 
+    def _collect_labels(self, ds: tf.data.Dataset) -> np.ndarray:
+        """Collect all labels of the given (unbatched) dataset into one numpy array.
+
+        The image data is dropped in the first map, so only the labels get batched and copied to host memory.
+        """
+        AUTOTUNE = tf.data.AUTOTUNE
+        labels_ds = ds.map(lambda _, y: y, num_parallel_calls=AUTOTUNE).batch(4096).prefetch(AUTOTUNE)
+        batches = [b for b in labels_ds.as_numpy_iterator()]
+        if not batches:
+            return np.empty((0,), np.int64)
+        return np.concatenate(batches).astype(np.int64, copy=False)
+
+    def _count_labels(self, ds: tf.data.Dataset, num_classes: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Count the datapoints per class of the given (unbatched) dataset in a single reduce pass.
+
+        Only classes which occur in the dataset are returned, like it is done by np.unique.
+        Raises a ValueError if the dataset contains labels outside of [0, num_classes).
+        """
+        AUTOTUNE = tf.data.AUTOTUNE
+        labels_ds = ds.map(lambda _, y: tf.cast(y, tf.int32), num_parallel_calls=AUTOTUNE).batch(8192)
+
+        def reduce_fn(state, y):
+            counts, n = state
+            # labels >= num_classes are not counted by bincount but in n, negative labels let bincount fail
+            counts += tf.math.bincount(y, minlength=num_classes, maxlength=num_classes, dtype=tf.int64)
+            return (counts, n + tf.cast(tf.size(y), tf.int64))
+
+        total, n = labels_ds.reduce((tf.zeros([num_classes], tf.int64), tf.constant(0, tf.int64)), reduce_fn)
+
+        class_counts = total.numpy()
+        if class_counts.sum() != n.numpy():
+            raise ValueError(f"Dataset contains {n.numpy() - class_counts.sum()} labels outside of the range [0, {num_classes}), "
+                             "'num_classes' does not match the dataset labels")
+
+        class_labels = np.arange(num_classes)
+        present = class_counts > 0
+        return (class_labels[present], class_counts[present])
+
     def calculate_class_imbalance(self) -> float:
         """Calculate class imbalance value for the train dataset.
 
@@ -420,15 +620,12 @@ class AbstractDataset():
         """
         _, class_counts, _ = self.get_class_distribution()
 
-        n: int = sum(class_counts)
-        k: int = len(class_counts)
-        H: float = 0.0
-        for c in class_counts:
-            H += (c / n) * np.log((c / n))
-
-        H *= -1
-        B: float = H / np.log(k)
-        return B
+        counts = np.asarray(class_counts, dtype=np.float64)
+        p = counts / counts.sum()
+        # 'where' skips empty classes, since p * log(p) -> 0 for p -> 0
+        H: float = -np.sum(p * np.log(p, where=p > 0, out=np.zeros_like(p)))
+        B: float = H / np.log(len(counts))
+        return float(B)
 
     def calculate_data_entropy(self, ds: Optional[tf.data.Dataset] = None) -> Tuple[Tuple[float, float, float], Tuple[float, float, float]]:
         """Calculate and return data entropy values and normed entropy values.
@@ -443,40 +640,50 @@ class AbstractDataset():
         2 (float, float, float) : normed average entropy value, normed min entropy value, normed max entropy value
 
         """
-        entropy_val_list: List[float] = []
-        normed_entropy_val_list: List[float] = []
+        AUTOTUNE = tf.data.AUTOTUNE
 
         if ds is None:
             ds = self.ds_train
 
-        for _, (data, _) in enumerate(ds):
-            values, counts = np.unique(data, return_counts=True)
-            entropy_val = scipy.stats.entropy(counts)
-            entropy_val_list.append(entropy_val)
+        entropy_ds = ds.map(lambda x, _: _img_entropy(x), num_parallel_calls=AUTOTUNE)
+
+        inf = tf.constant(np.inf, tf.float64)
+        initial_state = (tf.constant(0, tf.int64),
+                         tf.constant(0.0, tf.float64), inf, -inf,
+                         tf.constant(0.0, tf.float64), inf, -inf)
 
-            normed_entropy_val = entropy_val / np.log(len(values))
-            normed_entropy_val_list.append(normed_entropy_val)
+        def reduce_fn(state, entropy):
+            count, h_sum, h_min, h_max, hn_sum, hn_min, hn_max = state
+            h, hn = entropy
+            return (count + 1,
+                    h_sum + h, tf.minimum(h_min, h), tf.maximum(h_max, h),
+                    hn_sum + hn, tf.minimum(hn_min, hn), tf.maximum(hn_max, hn))
 
-        max_entropy = max(entropy_val_list)
-        min_entropy = min(entropy_val_list)
-        avg_entropy = sum(entropy_val_list) / len(entropy_val_list)
+        count, h_sum, min_entropy, max_entropy, hn_sum, normed_min_entropy, normed_max_entropy = [
+            t.numpy() for t in entropy_ds.reduce(initial_state, reduce_fn)]
 
-        normed_max_entropy = max(normed_entropy_val_list)
-        normed_min_entropy = min(normed_entropy_val_list)
-        normed_avg_entropy = sum(normed_entropy_val_list) / len(normed_entropy_val_list)
+        if count == 0:
+            raise ValueError("Cannot calculate data entropy of an empty dataset!")
+
+        avg_entropy = h_sum / count
+        normed_avg_entropy = hn_sum / count
 
         return ((avg_entropy, min_entropy, max_entropy), (normed_avg_entropy, normed_min_entropy, normed_max_entropy))
 
     def build_ds_info(self):
         """Build dataset info dictionary.
 
-        This function needs to be called after initializing and loading the dataset
+        This function needs to be called after initializing and loading the dataset.
+        The entropy values are only calculated if 'compute_entropy' is set, otherwise they are NaN.
         """
         class_counts, class_weights = self.calculate_class_weights()
         ds_count = self.get_dataset_count()
         total_count: int = sum(ds_count.values())
         class_imbalance: float = self.calculate_class_imbalance()
-        entropy_values, normed_entropy_values = self.calculate_data_entropy()
+        if self.compute_entropy:
+            entropy_values, normed_entropy_values = self.calculate_data_entropy()
+        else:
+            entropy_values, normed_entropy_values = ((float('nan'),) * 3, (float('nan'),) * 3)
 
         self.ds_info = {
             'name': self.dataset_name,
@@ -531,7 +738,7 @@ class GrayscaleToRgb(Layer):
 
 
 class RandomBrightness(Layer):
-    """Layer for random brightness augmentation in images."""
+    """Layer for random brightness augmentation in images or batches of images."""
 
     def __init__(self, factor=0.1, **kwargs):
         """Initialize RandomBrightness layer."""
@@ -539,8 +746,20 @@ class RandomBrightness(Layer):
         self.factor = factor
 
     def call(self, x):
-        return tf.image.random_brightness(x, max_delta=self.factor)
+        # draw one delta per image of a batch ([batch, 1, 1, 1]) and add it in a single broadcasted op,
+        # a single image ([height, width, channels]) gets one scalar delta
+        if x.shape.rank == 4:
+            shape = [tf.shape(x)[0], 1, 1, 1]
+        else:
+            shape = []
+
+        # like tf.image.adjust_brightness, integer images are converted to float [0, 1] and back
+        orig_dtype = x.dtype
+        if not orig_dtype.is_floating:
+            x = tf.image.convert_image_dtype(x, tf.float32)
 
+        delta = tf.random.uniform(shape, -self.factor, self.factor, dtype=x.dtype)
+        return tf.image.convert_image_dtype(x + delta, orig_dtype, saturate=True)
 
 class ModelPreprocessing(Layer):
     """Layer for specific model preprocessing steps."""
@@ -552,3 +771,46 @@ class ModelPreprocessing(Layer):
 
     def call(self, x):
         return self.pre_func(x)
+
+
+@tf.function
+def _img_entropy(x: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+    """Calculate the shannon entropy and the normed shannon entropy of the pixel values of a single image."""
+    flat = tf.reshape(x, [-1])
+    _, _, counts = tf.unique_with_counts(flat)
+    p = tf.cast(counts, tf.float64) / tf.cast(tf.size(flat), tf.float64)
+    entropy = -tf.reduce_sum(p * tf.math.log(p))
+    normed_entropy = entropy / tf.math.log(tf.cast(tf.size(counts), tf.float64))
+    return entropy, normed_entropy
+
+
+def _compose(ops: List[Callable[[tf.Tensor], tf.Tensor]]) -> Callable[[tf.Tensor], tf.Tensor]:
+    """Chain ops into a single function, without the call overhead of a keras Sequential model."""
+    ops = tuple(ops)
+
+    def composed(x: tf.Tensor) -> tf.Tensor:
+        for op in ops:
+            x = op(x)
+        return x
+    return composed
+
+
+def _jit_compile(fn: Callable[[tf.Tensor], tf.Tensor], spec: tf.TensorSpec, batched: bool) -> Callable[[tf.Tensor], tf.Tensor]:
+    """Wrap fn into a XLA compiled tf.function, so that the single ops get fused.
+
+    XLA compiles a new kernel for every new input shape, so fn is only compiled if the input shape (apart from the batch dimension) is known.
+    If fn cannot be compiled (f.e. an op has no XLA kernel in the used TF version), a tf.function without XLA is returned.
+    """
+    shape = spec.shape.as_list() if spec.shape.rank is not None else None
+    if shape is not None and None not in (shape[1:] if batched else shape):
+        jit_fn = tf.function(fn, jit_compile=True)
+        try:
+            # probe once if fn can be lowered to XLA, errors would otherwise only show up when iterating the dataset
+            # the function is only traced and not executed, and the probe targets the CPU since tf.data runs map functions there
+            with tf.device('/CPU:0'):
+                probe = tf.zeros([1 if dim is None else dim for dim in shape], spec.dtype)
+            jit_fn.experimental_get_compiler_ir(probe)(stage='hlo', device_name='/device:CPU:0')
+            return jit_fn
+        except (tf.errors.OpError, ValueError) as e:
+            print(f"Cannot compile function with XLA, falling back to tf.function without XLA: {e}")
+    return tf.function(fn, jit_compile=False)
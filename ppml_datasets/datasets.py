@@ -18,6 +18,7 @@ class MnistDataset(AbstractDataset):
                  dataset_path: str = "data"):
         """Initialize the MNIST dataset from AbstractDataset class."""
         super().__init__(dataset_name="mnist",
+                         num_classes=10,
                          dataset_path=dataset_path,
                          dataset_img_shape=(28, 28, 1),
                          model_img_shape=model_img_shape,
@@ -46,6 +47,7 @@ class FashionMnistDataset(AbstractDataset):
                  dataset_path: str = "data"):
         """Initialize the FMNIST dataset from AbstractDataset class."""
         super().__init__(dataset_name="fashion_mnist",
+                         num_classes=10,
                          dataset_path=dataset_path,
                          dataset_img_shape=(28, 28, 1),
                          model_img_shape=model_img_shape,
@@ -66,6 +68,7 @@ class Cifar10Dataset(AbstractDataset):
                  dataset_path: str = "data"):
         """Initialize the CIFAR10 dataset from AbstractDataset class."""
         super().__init__(dataset_name="cifar10",
+                         num_classes=10,
                          dataset_path=dataset_path,
                          dataset_img_shape=(32, 32, 3),
                          model_img_shape=model_img_shape,
@@ -86,6 +89,7 @@ class Cifar100Dataset(AbstractDataset):
                  dataset_path: str = "data"):
         """Initialize the CIFAR100 dataset from AbstractDataset class."""
         super().__init__(dataset_name="cifar100",
+                         num_classes=100,
                          dataset_path=dataset_path,
                          dataset_img_shape=(32, 32, 3),
                          model_img_shape=model_img_shape,
@@ -104,6 +108,7 @@ class ImagenetteDataset(AbstractDataset):
                  preprocessing_func: Optional[Callable[[float], tf.Tensor]] = None):
         """Initialize the full size v2 imagenette dataset from AbstractDataset class."""
         super().__init__(dataset_name="imagenette/full-size-v2",
+                         num_classes=10,
                          dataset_path="data",
                          dataset_img_shape=(None, None, 3),
                          model_img_shape=model_img_shape,
@@ -125,6 +130,7 @@ class Covid19RadiographyDataset(AbstractDataset):
                  preprocessing_func: Optional[Callable[[float], tf.Tensor]] = None):
         """Initialize the Covid19 dataset from AbstractDataset class."""
         super().__init__(dataset_name="covid19-radiography",
+                         num_classes=2,
                          dataset_path=dataset_path,
                          dataset_img_shape=(299, 299, 3),
                          model_img_shape=model_img_shape,
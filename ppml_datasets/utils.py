@@ -104,13 +104,38 @@ def filter_labels(y, allowed_classes: list):
 
 
 def get_ds_as_numpy(ds: tf.data.Dataset) -> Tuple[np.ndarray, np.ndarray]:
+    """Return batched dataset as unbatched (values, labels) numpy arrays, which are filled batch-wise into preallocated arrays."""
     if ds is None:
         print("Cannot convert dataset to numpy arrays! Dataset is not initialized!")
         return
 
-    values = []
-    labels = []
-    for x, y in ds.unbatch().as_numpy_iterator():
-        values.append(x)
-        labels.append(y)
-    return (np.asarray(values), np.asarray(labels))
+    def empty_array(spec: tf.TensorSpec) -> np.ndarray:
+        # (0,) + element shape of the unbatched data, unknown dimensions are set to 0
+        return np.empty((0,) + tuple(0 if dim is None else dim for dim in spec.shape[1:]), spec.dtype.as_numpy_dtype)
+
+    x_spec, y_spec = ds.element_spec
+
+    card = int(ds.cardinality())
+    if card < 0:
+        # without known cardinality the arrays cannot be preallocated, so the batches are concatenated once at the end
+        batches = list(ds.as_numpy_iterator())
+        if not batches:
+            return (empty_array(x_spec), empty_array(y_spec))
+        return (np.concatenate([x for x, _ in batches]), np.concatenate([y for _, y in batches]))
+
+    values = None
+    labels = None
+    n = 0
+    for x, y in ds.as_numpy_iterator():
+        if values is None:
+            # the last batch can be smaller, so the preallocated arrays are trimmed after filling
+            max_len = card * len(x)
+            values = np.empty((max_len,) + x.shape[1:], x.dtype)
+            labels = np.empty((max_len,) + y.shape[1:], y.dtype)
+        values[n:n + len(x)] = x
+        labels[n:n + len(y)] = y
+        n += len(x)
+
+    if values is None:
+        return (empty_array(x_spec), empty_array(y_spec))
+    return (values[:n], labels[:n])
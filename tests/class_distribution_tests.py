@@ -0,0 +1,58 @@
+import unittest
+import numpy as np
+import tensorflow as tf
+from sklearn.utils import class_weight
+
+from ppml_datasets.abstract_dataset_handler import AbstractDataset
+
+
+def build_dataset(labels, num_classes=None) -> AbstractDataset:
+    ds = AbstractDataset(dataset_name="test", dataset_path=None, model_img_shape=(2, 2, 1),
+                         batch_size=None, convert_to_rgb=False, augment_train=False,
+                         shuffle=False, is_tfds_ds=False, num_classes=num_classes)
+    x = np.zeros((len(labels), 2, 2, 1), dtype=np.uint8)
+    ds.ds_train = tf.data.Dataset.from_tensor_slices((x, np.array(labels, dtype=np.int64)))
+    return ds
+
+
+class CountLabelsTestCase(unittest.TestCase):
+
+    def test_in_range(self):
+        labels = [0, 1, 1, 2, 2, 2]
+        class_labels, class_counts, class_distribution = build_dataset(labels, num_classes=3).get_class_distribution()
+
+        np.testing.assert_array_equal(class_labels, [0, 1, 2])
+        np.testing.assert_array_equal(class_counts, [1, 2, 3])
+        self.assertIsNone(class_distribution)
+
+    def test_missing_class(self):
+        labels = [0, 2, 2, 4]
+        class_labels, class_counts, _ = build_dataset(labels, num_classes=5).get_class_distribution()
+        unique_labels, unique_counts = np.unique(labels, return_counts=True)
+
+        np.testing.assert_array_equal(class_labels, unique_labels)
+        np.testing.assert_array_equal(class_counts, unique_counts)
+
+        # same result as collecting all labels without num_classes
+        class_labels, class_counts, _ = build_dataset(labels).get_class_distribution()
+        np.testing.assert_array_equal(class_labels, unique_labels)
+        np.testing.assert_array_equal(class_counts, unique_counts)
+
+    def test_out_of_range(self):
+        ds = build_dataset([0, 1, 3], num_classes=3)
+        self.assertRaises(ValueError, ds.get_class_distribution)
+
+
+class ClassWeightsTestCase(unittest.TestCase):
+
+    def test_missing_class(self):
+        labels = [0, 0, 0, 2]
+        expected = class_weight.compute_class_weight(class_weight='balanced', classes=np.array([0, 2]), y=np.array(labels))
+
+        for num_classes in (3, None):
+            class_counts, class_weights = build_dataset(labels, num_classes=num_classes).calculate_class_weights()
+
+            self.assertEqual(sorted(class_counts.keys()), [0, 2])
+            self.assertEqual(sorted(class_weights.keys()), [0, 2])
+            self.assertAlmostEqual(class_weights[0], expected[0])
+            self.assertAlmostEqual(class_weights[2], expected[1])
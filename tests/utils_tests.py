@@ -0,0 +1,39 @@
+import unittest
+import numpy as np
+import tensorflow as tf
+
+from ppml_datasets.utils import get_ds_as_numpy
+
+
+class GetDsAsNumpyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.arange(7 * 2 * 2, dtype=np.uint8).reshape((7, 2, 2))
+        self.y = np.arange(7, dtype=np.int64)
+
+    def test_smaller_last_batch(self):
+        ds = tf.data.Dataset.from_tensor_slices((self.x, self.y)).batch(3)
+        values, labels = get_ds_as_numpy(ds)
+
+        self.assertEqual(values.shape, (7, 2, 2))
+        self.assertEqual(values.dtype, np.uint8)
+        np.testing.assert_array_equal(values, self.x)
+        np.testing.assert_array_equal(labels, self.y)
+
+    def test_unknown_cardinality(self):
+        ds = tf.data.Dataset.from_tensor_slices((self.x, self.y)).filter(lambda x, y: y % 2 == 0).batch(3)
+        values, labels = get_ds_as_numpy(ds)
+
+        np.testing.assert_array_equal(values, self.x[::2])
+        np.testing.assert_array_equal(labels, self.y[::2])
+
+    def test_empty(self):
+        ds = tf.data.Dataset.from_tensor_slices((self.x, self.y)).take(0).batch(3)
+        values, labels = get_ds_as_numpy(ds)
+        self.assertEqual(values.shape, (0, 2, 2))
+        self.assertEqual(values.dtype, np.uint8)
+        self.assertEqual(labels.shape, (0,))
+
+        values, labels = get_ds_as_numpy(ds.filter(lambda x, y: True))
+        self.assertEqual(values.shape, (0, 2, 2))
+        self.assertEqual(labels.dtype, np.int64)